@@ -0,0 +1,479 @@
+"""Sharded TrOCR fine-tuning dataset.
+
+`build` crops every labelled box out of the page images once, runs the
+processor's resize/normalize on the crops and tokenizes the labels, then
+packs the result into fixed-size shards:
+
+    shard-00000.pixels.npy   (n, 3, H, W) pixel values
+    shard-00000.labels.npy   flat int32 token ids of all n labels
+    shard-00000.offsets.npy  (n + 1,) int64, labels of sample i are
+                             labels[offsets[i]:offsets[i + 1]]
+    index.json               shard list, sample counts and build settings
+
+All arrays are plain .npy files so the loader can open them with
+mmap_mode="r" and never touch a JPEG again.
+
+Usage:
+    python trocr_dataset.py build data/trocr-shards
+    python trocr_dataset.py check data/trocr-shards
+    python trocr_dataset.py selftest
+"""
+import argparse
+import glob
+import json
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import types
+import warnings
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+ANNOTATION_GLOB = "annotations/*_annotations.json"
+PRELABEL_FILE = "easyocr_prelabels.json"
+# output/ holds the binarized pages the boxes were drawn on, CD/ the raw scans
+IMAGE_DIRS = ("output", "CD")
+DEFAULT_PROCESSOR = "microsoft/trocr-base-handwritten"
+INDEX_FILE = "index.json"
+DEFAULT_WORKERS = 4
+# Enough shards that every worker gets a few and shuffling their order matters
+SHARDS_PER_WORKER = 4
+# Crops sent through the processor at once, bounds the float32 batch it returns
+PROCESSOR_BATCH = 32
+
+
+def load_labels(annotation_glob=ANNOTATION_GLOB, prelabel_file=PRELABEL_FILE,
+                prelabel_min_confidence=None):
+    """Return {image_filename: detections}.
+
+    The raw easyocr prelabels are only used when prelabel_min_confidence is
+    set, and then only their detections at or above it. Hand-corrected
+    annotations/*_annotations.json always win over prelabels for the same page.
+    """
+    labels = {}
+    if prelabel_min_confidence is not None and os.path.exists(prelabel_file):
+        with open(prelabel_file, 'r') as f:
+            for entry in json.load(f):
+                labels[entry["image_filename"]] = [
+                    det for det in entry["detections"]
+                    if det.get("confidence", 0) >= prelabel_min_confidence]
+    for path in sorted(glob.glob(annotation_glob)):
+        with open(path, 'r') as f:
+            for entry in json.load(f):
+                labels[entry["image_filename"]] = entry["detections"]
+    return labels
+
+
+def find_image(filename, image_dirs=IMAGE_DIRS):
+    for d in image_dirs:
+        path = os.path.join(d, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def box_to_rect(bounding_box, width, height):
+    """Axis-aligned (left, top, right, bottom) of a 4-point box, clipped to the page."""
+    xs = [p[0] for p in bounding_box]
+    ys = [p[1] for p in bounding_box]
+    left, top = max(0, int(min(xs))), max(0, int(min(ys)))
+    right, bottom = min(width, int(round(max(xs)))), min(height, int(round(max(ys))))
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right, bottom
+
+
+def plan_pages(labels, image_dirs=IMAGE_DIRS):
+    """Return [(filename, path, [(rect, text), ...])] without decoding any image.
+
+    Only the image header is read for the page size, so the sample count is
+    known before the shards are allocated.
+    """
+    pages = []
+    for filename in sorted(labels):
+        path = find_image(filename, image_dirs)
+        if path is None:
+            print(f"skipping {filename}: image not found in {', '.join(image_dirs)}")
+            continue
+        with Image.open(path) as im:
+            width, height = im.size
+        samples = []
+        for det in labels[filename]:
+            text = det.get("text", "").strip()
+            rect = box_to_rect(det["bounding_box"], width, height)
+            if text and rect is not None:
+                samples.append((rect, text))
+        if samples:
+            pages.append((filename, path, samples))
+    return pages
+
+
+def default_shard_size(num_samples, num_workers=DEFAULT_WORKERS):
+    return max(1, math.ceil(num_samples / (num_workers * SHARDS_PER_WORKER)))
+
+
+class ShardWriter:
+    """Writes samples to arbitrary global rows of preallocated, memory-mapped shards.
+
+    Pixels go straight into the shard files as they arrive; the small token id
+    arrays are kept until close(), which writes each shard's labels and offsets.
+    """
+
+    def __init__(self, out_dir, num_samples, shard_size, pixel_dtype):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        full, rest = divmod(num_samples, shard_size)
+        self.sizes = [shard_size] * full + ([rest] if rest else [])
+        self.pixel_dtype = pixel_dtype
+        self.pixels = None
+        self.labels = [None] * num_samples
+
+    def name(self, shard):
+        return f"shard-{shard:05d}"
+
+    def write(self, row, pixel_values, label_ids):
+        if self.pixels is None:
+            self.pixels = [np.lib.format.open_memmap(
+                os.path.join(self.out_dir, self.name(i) + ".pixels.npy"), mode="w+",
+                dtype=self.pixel_dtype, shape=(size, *pixel_values.shape))
+                for i, size in enumerate(self.sizes)]
+        shard, i = divmod(row, self.shard_size)
+        self.pixels[shard][i] = pixel_values
+        self.labels[row] = np.asarray(label_ids, dtype=np.int32)
+
+    def close(self):
+        missing = sum(ids is None for ids in self.labels)
+        if missing:
+            raise RuntimeError(f"{missing} of {len(self.labels)} planned samples not written")
+        shards = []
+        for shard, size in enumerate(self.sizes):
+            name = self.name(shard)
+            labels = self.labels[shard * self.shard_size:shard * self.shard_size + size]
+            offsets = np.zeros(size + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(ids) for ids in labels])
+            self.pixels[shard].flush()
+            np.save(os.path.join(self.out_dir, name + ".labels.npy"), np.concatenate(labels))
+            np.save(os.path.join(self.out_dir, name + ".offsets.npy"), offsets)
+            shards.append({"name": name, "size": size})
+        self.pixels = None
+        return shards
+
+
+def build(out_dir, processor_name=DEFAULT_PROCESSOR, shard_size=None,
+          max_target_length=64, pixel_dtype="float16", seed=0,
+          prelabel_min_confidence=None, processor=None,
+          annotation_glob=ANNOTATION_GLOB, prelabel_file=PRELABEL_FILE,
+          image_dirs=IMAGE_DIRS):
+    if processor is None:
+        from transformers import TrOCRProcessor
+        processor = TrOCRProcessor.from_pretrained(processor_name)
+    os.makedirs(out_dir, exist_ok=True)
+
+    labels = load_labels(annotation_glob, prelabel_file, prelabel_min_confidence)
+    pages = plan_pages(labels, image_dirs)
+    num_samples = sum(len(samples) for _, _, samples in pages)
+    if shard_size is None:
+        shard_size = default_shard_size(num_samples)
+
+    # Every sample gets a random global row, so each shard mixes words from
+    # all pages while pages are still decoded one at a time, in order.
+    rows = list(range(num_samples))
+    random.Random(seed).shuffle(rows)
+    rows = iter(rows)
+
+    writer = ShardWriter(out_dir, num_samples, shard_size, np.dtype(pixel_dtype))
+    pixel_shape = None
+    for filename, path, samples in pages:
+        with Image.open(path) as im:
+            im = im.convert("RGB")
+            for i in range(0, len(samples), PROCESSOR_BATCH):
+                batch = samples[i:i + PROCESSOR_BATCH]
+                crops = [im.crop(rect) for rect, _ in batch]
+                pixel_values = processor(images=crops, return_tensors="np").pixel_values
+                label_ids = processor.tokenizer([text for _, text in batch],
+                                                max_length=max_target_length,
+                                                truncation=True).input_ids
+                pixel_shape = list(pixel_values.shape[1:])
+                for px, ids in zip(pixel_values, label_ids):
+                    writer.write(next(rows), px, ids)
+        print(f"{filename}: {len(samples)} crops")
+    shards = writer.close()
+
+    index = {
+        "processor": processor_name,
+        "pixel_shape": pixel_shape,
+        "pixel_dtype": str(np.dtype(pixel_dtype)),
+        "max_target_length": max_target_length,
+        "shard_size": shard_size,
+        "prelabel_min_confidence": prelabel_min_confidence,
+        "num_samples": num_samples,
+        "shards": shards,
+    }
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=4)
+    print(f"wrote {num_samples} samples in {len(shards)} shards to {out_dir}")
+    return index
+
+
+def read_index(root):
+    with open(os.path.join(root, INDEX_FILE), 'r') as f:
+        return json.load(f)
+
+
+def open_shard(root, name):
+    """Memory-map one shard; returns (pixels, labels, offsets)."""
+    return tuple(np.load(os.path.join(root, f"{name}.{part}.npy"), mmap_mode="r")
+                 for part in ("pixels", "labels", "offsets"))
+
+
+class ShardedCropDataset(IterableDataset):
+    """Streams samples from the shards written by `build`.
+
+    Call set_epoch(epoch) before each epoch. The shard order is reshuffled
+    from (seed, epoch) identically in every worker, and worker k reads every
+    num_workers-th shard of that order, so each sample is seen exactly once
+    per epoch. Samples within a shard are shuffled too; that's cheap because
+    the arrays are memory-mapped.
+
+    The epoch lives in shared memory, so set_epoch in the training loop
+    reaches the workers whether they are persistent (as in `make_loader`)
+    or not.
+    """
+
+    def __init__(self, root, shuffle=True, seed=0):
+        self.root = root
+        self.index = read_index(root)
+        self.shuffle = shuffle
+        self.seed = seed
+        self._epoch = multiprocessing.Value("q", 0, lock=False)
+
+    def __len__(self):
+        # Samples, not what the loader yields: every worker ends on its own
+        # partial batch, so use num_batches() rather than len(loader).
+        return self.index["num_samples"]
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def worker_shards(self, epoch, worker_id=0, num_workers=1):
+        """The (name, size) shards worker_id streams in the given epoch."""
+        shards = [(s["name"], s["size"]) for s in self.index["shards"]]
+        if self.shuffle:
+            random.Random(f"{self.seed}-{epoch}").shuffle(shards)
+        return shards[worker_id::max(1, num_workers)]
+
+    def num_batches(self, batch_size, num_workers, epoch=None):
+        """Batches a DataLoader with these settings yields in an epoch (default: current)."""
+        epoch = self._epoch.value if epoch is None else epoch
+        return sum(math.ceil(sum(size for _, size in self.worker_shards(epoch, k, num_workers))
+                             / batch_size)
+                   for k in range(max(1, num_workers)))
+
+    def __iter__(self):
+        epoch = self._epoch.value
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, shards = 0, self.worker_shards(epoch)
+        else:
+            worker_id, shards = worker.id, self.worker_shards(epoch, worker.id, worker.num_workers)
+        rng = random.Random(f"{self.seed}-{epoch}-{worker_id}")
+
+        for name, _ in shards:
+            pixels, labels, offsets = open_shard(self.root, name)
+            order = list(range(len(pixels)))
+            if self.shuffle:
+                rng.shuffle(order)
+            for i in order:
+                yield {
+                    "pixel_values": torch.from_numpy(np.array(pixels[i], dtype=np.float32)),
+                    "labels": torch.from_numpy(labels[offsets[i]:offsets[i + 1]].astype(np.int64)),
+                }
+
+
+def collate(batch):
+    """Stack pixel values and pad labels with -100 so the loss ignores padding."""
+    pixel_values = torch.stack([b["pixel_values"] for b in batch])
+    longest = max(len(b["labels"]) for b in batch)
+    labels = torch.full((len(batch), longest), -100, dtype=torch.long)
+    for i, b in enumerate(batch):
+        labels[i, :len(b["labels"])] = b["labels"]
+    return {"pixel_values": pixel_values, "labels": labels}
+
+
+def make_loader(root, batch_size=16, num_workers=DEFAULT_WORKERS, shuffle=True, seed=0):
+    """DataLoader over the shards; call loader.dataset.set_epoch(epoch) each epoch.
+
+    len(loader) undercounts with several workers, since each one ends its
+    stream on a partial batch. Size LR schedules from
+    loader.dataset.num_batches(loader.batch_size, loader.num_workers).
+    """
+    dataset = ShardedCropDataset(root, shuffle=shuffle, seed=seed)
+    num_shards = len(dataset.index["shards"])
+    if num_shards < num_workers:
+        # Shards are split between workers, the extra ones would only idle
+        warnings.warn(f"{root} has {num_shards} shards for {num_workers} workers, "
+                      f"using {num_shards}; rebuild with a smaller --shard-size")
+        num_workers = num_shards
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
+    )
+
+
+def check(root, batch_size=16, num_workers=DEFAULT_WORKERS):
+    index = read_index(root)
+    print(f"{index['num_samples']} samples in {len(index['shards'])} shards, "
+          f"pixels {index['pixel_shape']} {index['pixel_dtype']}")
+    loader = make_loader(root, batch_size=batch_size, num_workers=num_workers)
+    loader.dataset.set_epoch(0)
+    seen = sum(len(batch["pixel_values"]) for batch in loader)
+    print(f"streamed {seen} samples")
+
+
+class _FakeProcessor:
+    """Stands in for TrOCRProcessor: pixels hold the crop width, tokens are code points."""
+
+    def __call__(self, images, return_tensors="np"):
+        pixel_values = np.stack([np.full((3, 4, 4), im.size[0], dtype=np.float32)
+                                 for im in images])
+        return types.SimpleNamespace(pixel_values=pixel_values)
+
+    def tokenizer(self, texts, max_length, truncation):
+        return types.SimpleNamespace(input_ids=[[ord(c) for c in t][:max_length] for t in texts])
+
+
+def _box(left, top, right, bottom):
+    return [[left, top], [right, top], [right, bottom], [left, bottom]]
+
+
+def selftest(num_workers=2):
+    """Build and stream a synthetic 2-page fixture, no model or real pages needed."""
+    assert box_to_rect(_box(10, 20, 30, 40), 100, 100) == (10, 20, 30, 40)
+    assert box_to_rect([[15, 10], [30, 15], [25, 40], [10, 35]], 100, 100) == (10, 10, 30, 40)
+    assert box_to_rect(_box(-5, 90, 20, 120), 100, 100) == (0, 90, 20, 100)
+    assert box_to_rect(_box(120, 10, 150, 20), 100, 100) is None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "output"))
+        os.makedirs(os.path.join(tmp, "annotations"))
+        for page in ("page-0.jpg", "page-1.jpg"):
+            Image.new("L", (400, 100)).save(os.path.join(tmp, "output", page))
+
+        # Box k is 10 + k wide and labelled "w<k>", so pixels identify the text
+        def det(k, confidence=0.9):
+            return {"bounding_box": _box(k * 12, 10, k * 12 + 10 + k, 50),
+                    "text": f"w{k}", "confidence": confidence}
+
+        annotated = [det(k) for k in range(7)]
+        annotated.append({"bounding_box": _box(0, 60, 20, 90), "text": " ", "confidence": 1})
+        annotated.append({"bounding_box": _box(500, 0, 520, 20), "text": "off", "confidence": 1})
+        prelabel_1 = [det(k) for k in range(7, 13)] + [det(13, 0.1), det(14, 0.2)]
+        prelabels = [
+            {"image_filename": "page-0.jpg", "detections": [det(k, 0.95) for k in range(20, 24)]},
+            {"image_filename": "page-1.jpg", "detections": prelabel_1},
+        ]
+        prelabel_file = os.path.join(tmp, "prelabels.json")
+        with open(prelabel_file, 'w') as f:
+            json.dump(prelabels, f)
+        with open(os.path.join(tmp, "annotations", "page-0_annotations.json"), 'w') as f:
+            json.dump([{"image_filename": "page-0.jpg", "detections": annotated}], f)
+        annotation_glob = os.path.join(tmp, "annotations", "*_annotations.json")
+        image_dirs = (os.path.join(tmp, "output"),)
+
+        labels = load_labels(annotation_glob, prelabel_file)
+        assert list(labels) == ["page-0.jpg"]
+        labels = load_labels(annotation_glob, prelabel_file, prelabel_min_confidence=0.5)
+        assert [d["text"] for d in labels["page-0.jpg"]][:7] == [f"w{k}" for k in range(7)]
+        assert [d["text"] for d in labels["page-1.jpg"]] == [f"w{k}" for k in range(7, 13)]
+
+        root = os.path.join(tmp, "shards")
+        index = build(root, processor_name="selftest", shard_size=3,
+                      prelabel_min_confidence=0.5, processor=_FakeProcessor(),
+                      annotation_glob=annotation_glob, prelabel_file=prelabel_file,
+                      image_dirs=image_dirs)
+        expected = {f"w{k}" for k in range(13)}
+        assert index["num_samples"] == len(expected)
+        assert [s["size"] for s in index["shards"]] == [3, 3, 3, 3, 1]
+        assert index["prelabel_min_confidence"] == 0.5
+
+        mixed = False
+        for shard in index["shards"]:
+            pixels, flat, offsets = open_shard(root, shard["name"])
+            assert len(pixels) == len(offsets) - 1 == shard["size"]
+            assert offsets[0] == 0 and offsets[-1] == len(flat)
+            assert all(np.diff(offsets) > 0)
+            ks = [int("".join(chr(t) for t in flat[offsets[i]:offsets[i + 1]])[1:])
+                  for i in range(len(pixels))]
+            assert [float(px[0, 0, 0]) for px in pixels] == [10.0 + k for k in ks]
+            # w0-w6 come from page-0, w7-w12 from page-1
+            mixed |= len({k < 7 for k in ks}) == 2
+        assert mixed, "every shard holds crops from a single page"
+
+        loader = make_loader(root, batch_size=4, num_workers=num_workers)
+        orders = []
+        for epoch in range(2):
+            loader.dataset.set_epoch(epoch)
+            order = []
+            batches = 0
+            for batch in loader:
+                batches += 1
+                for px, ids in zip(batch["pixel_values"], batch["labels"]):
+                    text = "".join(chr(t) for t in ids.tolist() if t != -100)
+                    assert px.dtype == torch.float32
+                    assert px[0, 0, 0].item() == 10 + int(text[1:])
+                    order.append(text)
+            assert sorted(order) == sorted(expected), order
+            assert batches == loader.dataset.num_batches(loader.batch_size, loader.num_workers)
+            orders.append(order)
+        assert orders[0] != orders[1]
+
+        padded = collate([{"pixel_values": torch.zeros(3, 4, 4), "labels": torch.tensor([1, 2, 3])},
+                          {"pixel_values": torch.zeros(3, 4, 4), "labels": torch.tensor([4])}])
+        assert padded["pixel_values"].shape == (2, 3, 4, 4)
+        assert padded["labels"].tolist() == [[1, 2, 3], [4, -100, -100]]
+    print("selftest ok")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="crop, preprocess and shard the labelled boxes")
+    p.add_argument("out_dir")
+    p.add_argument("--processor", default=DEFAULT_PROCESSOR)
+    p.add_argument("--shard-size", type=int, default=None,
+                   help=f"samples per shard, default gives {SHARDS_PER_WORKER} shards "
+                        f"per worker for {DEFAULT_WORKERS} workers")
+    p.add_argument("--max-target-length", type=int, default=64)
+    p.add_argument("--pixel-dtype", default="float16", choices=("float16", "float32"))
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--prelabel-min-confidence", type=float, default=None,
+                   help="also train on easyocr prelabels at or above this confidence "
+                        "for pages without hand-corrected annotations")
+
+    p = sub.add_parser("check", help="stream one epoch through the loader")
+    p.add_argument("root")
+    p.add_argument("--batch-size", type=int, default=16)
+    p.add_argument("--num-workers", type=int, default=DEFAULT_WORKERS)
+
+    p = sub.add_parser("selftest", help="build and stream a synthetic fixture")
+    p.add_argument("--num-workers", type=int, default=2)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.out_dir, args.processor, args.shard_size, args.max_target_length,
+              args.pixel_dtype, args.seed, args.prelabel_min_confidence)
+    elif args.command == "check":
+        check(args.root, args.batch_size, args.num_workers)
+    else:
+        selftest(args.num_workers)